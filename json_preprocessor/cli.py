@@ -1,69 +1,334 @@
+import io
 import os
-import boto3
+import sys
 #import click
 import json
 import fnmatch
-from urllib.parse import urldefrag, urlsplit, urlparse
+import re
+import shelve
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from urllib.parse import urlsplit
 from .resolution import resolve
 
-REGION = os.getenv('AWS_REGION')
-if REGION is None:
-    raise Exception('AWS_REGION not set')
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# matches a run of digits long enough to be an integer wider than 64 bits
+WIDE_INTEGER_PATTERN = re.compile(rb'\d{19,}')
+
+def _load_json(data):
+    """Parse a JSON document from a binary file object, using orjson when it
+       is available.
+
+       orjson reads integers wider than 64 bits as floats, so documents that
+       may contain one are parsed by the json module instead, which keeps
+       them exact. Documents that orjson rejects but the json module accepts,
+       such as those starting with a UTF-8 byte order mark, also fall back to
+       the json module.
+    """
+    if orjson is None:
+        return json.load(data)
+
+    raw = data.read()
+    if WIDE_INTEGER_PATTERN.search(raw):
+        return json.loads(raw)
+    try:
+        return orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        return json.loads(raw)
+
+def _dumps_minified(tree):
+    """Serialise a JSON tree without whitespace, as UTF-8 bytes, using orjson
+       when it is available.
+
+       Non-ASCII characters are written as-is, except for lone surrogates,
+       which cannot be encoded as UTF-8 and so are escaped. orjson writes NaN
+       and infinite floats as null, so any output containing null is encoded
+       again by the json module, which writes them as the json module always
+       has. The json module is also used for trees that orjson cannot encode
+       at all, such as those holding integers wider than 64 bits. Otherwise
+       the two encoders only differ in how some floats are formatted.
+    """
+    if orjson is not None:
+        try:
+            resolved = orjson.dumps(tree)
+            if b'null' not in resolved:
+                return resolved
+        except orjson.JSONEncodeError:
+            pass
+
+    resolved = json.dumps(tree, separators=(',', ':'), ensure_ascii=False)
+    try:
+        return resolved.encode('utf-8')
+    except UnicodeEncodeError:
+        return json.dumps(tree, separators=(',', ':')).encode('utf-8')
+
+# matches any character that fnmatch treats as a wildcard
+WILDCARD_PATTERN = re.compile(r'[*?[]')
 
 # keyed on stack name
-# values are a dict keyed on aws:cdk:path that contain the physical name
+# values are a dict containing the time at which the stack was fetched
+# ('fetched_at'), whether it was read from the on-disk cache ('from_cache'),
+# the physical name of each resource keyed on its logical name ('resources'),
+# and the physical names keyed on aws:cdk:path ('paths'); the paths are only
+# fetched once a lookup needs them, until then they are None
 STACK_LOOKUP = {}
 
-def retrieve_attribute(stack_name, path):
-    """Retrieve an attribute for a CloudFormation resource using boto."""
-    #print('retrieve_attribute', stack_name, path)
+# keyed on (stack name, pattern)
+# values are a tuple of the physical names matching a wildcard aws:cdk:path
+WILDCARD_LOOKUP = {}
+
+# the command line utility also persists stack lookups between runs; entries
+# older than the cache TTL (CACHE_TTL seconds by default) are fetched again,
+# and a TTL of None disables the cache; CACHE_VERSION is part of every key, and
+# is bumped whenever the layout of the stored lookups changes
+CACHE_DIR = os.path.expanduser('~/.cache/json-preprocessor')
+CACHE_TTL = 60
+CACHE_VERSION = 2
+
+@contextmanager
+def _buffered_stdout():
+    """Wrap STDOUT in a large buffer, so that streaming a multi-megabyte
+       document to it takes few writes.
+    """
+    sys.stdout.flush()
+    out = io.TextIOWrapper(io.BufferedWriter(sys.stdout.buffer, 1 << 20),
+                           encoding=sys.stdout.encoding,
+                           errors=sys.stdout.errors)
+    try:
+        yield out
+    finally:
+        # flush everything through, but leave STDOUT itself open
+        out.flush()
+        out.detach().detach()
+
+@lru_cache(maxsize=None)
+def _region():
+    """Return the AWS region to connect to, as set by AWS_REGION."""
+    region = os.getenv('AWS_REGION')
+    if region is None:
+        raise Exception('AWS_REGION not set')
+    return region
+
+@lru_cache(maxsize=None)
+def _cfn_client(region):
+    """Return a CloudFormation client for the given region, constructing it
+       only the first time that region is requested.
+
+       boto3 is imported here rather than at module level, so that it is only
+       loaded once a cfn:// reference actually needs to be resolved.
+    """
+    import boto3
+    from botocore.config import Config
+
+    # keep-alive connections in the pool are reused across requests
+    config = Config(max_pool_connections=50,
+                    retries={'max_attempts': 10, 'mode': 'adaptive'})
+    return boto3.client('cloudformation', region_name=region, config=config)
+
+def _fetch_stack_resources(stack_name):
+    """Build a dict keyed on logical name containing the physical name of each
+       resource in a CloudFormation stack.
+    """
+    client = _cfn_client(_region())
+
+    # pages are followed by hand rather than through a paginator, which
+    # avoids loading the paginator model; the page size is fixed by
+    # CloudFormation, as ListStackResources has no MaxResults parameter
+    resources = {}
+    kwargs = {'StackName': stack_name}
+    while True:
+        res = client.list_stack_resources(**kwargs)
+        for res2 in res['StackResourceSummaries']:
+            if 'PhysicalResourceId' in res2:
+                resources[res2['LogicalResourceId']] = \
+                    res2['PhysicalResourceId']
+
+        token = res.get('NextToken')
+        if not token:
+            break
+        kwargs['NextToken'] = token
+
+    return resources
+
+def _fetch_stack_paths(stack_name, resources):
+    """Build a dict keyed on aws:cdk:path containing the physical name of each
+       resource in a CloudFormation stack.
+    """
+    client = _cfn_client(_region())
+
+    # the processed template carries the Metadata for every resource, so a
+    # single request replaces one describe_stack_resource per resource
+    template = client.get_template(StackName=stack_name,
+                                   TemplateStage='Processed')
+    template = template['TemplateBody']
+    if isinstance(template, str):
+        # botocore has already decoded any JSON body, so this is a YAML
+        # template, which cannot have been synthesized by CDK
+        return {}
+
+    paths = {}
+    for idn, resource in template.get('Resources', {}).items():
+        metadata = resource.get('Metadata', {})
+        if 'aws:cdk:path' in metadata and idn in resources:
+            paths[metadata['aws:cdk:path']] = resources[idn]
+
+    return paths
+
+@contextmanager
+def _open_cache(flag, exclusive):
+    """Open the on-disk cache, holding a lock on it so that parallel runs do
+       not corrupt the database.
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(os.path.join(CACHE_DIR, 'stacks.lock'), 'a') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        with shelve.open(os.path.join(CACHE_DIR, 'stacks'), flag) as cache:
+            yield cache
+
+def _cache_key(stack_name):
+    return 'v{}:{}@{}'.format(CACHE_VERSION, stack_name, _region())
+
+def _read_cached_stack(stack_name, cache_ttl):
+    """Return the on-disk copy of a stack lookup, or None if the cache is
+       disabled, unreadable, or does not hold a sufficiently recent copy.
+    """
+    if cache_ttl is None:
+        return None
+
+    key = _cache_key(stack_name)
+    try:
+        with _open_cache('r', exclusive=False) as cache:
+            stack = cache.get(key)
+    except Exception:
+        # the cache is only an optimisation, so treat any failure as a miss
+        return None
+    if stack is None or time.time() - stack['fetched_at'] >= cache_ttl:
+        return None
+    return stack
+
+def _write_cached_stack(stack_name, stack, cache_ttl):
+    """Save a copy of a stack lookup to the on-disk cache, if it is enabled."""
+    if cache_ttl is None:
+        return
+
+    key = _cache_key(stack_name)
+    try:
+        with _open_cache('c', exclusive=True) as cache:
+            cache[key] = stack
+    except Exception:
+        # a stack that cannot be saved is simply fetched again next run
+        pass
 
+def _store_stack(stack_name, stack):
+    """Make a stack lookup the current one for its stack."""
     global STACK_LOOKUP
+    STACK_LOOKUP[stack_name] = stack
+
+    # any wildcard matches were made against an older copy of the stack
+    for key in [key for key in WILDCARD_LOOKUP if key[0] == stack_name]:
+        del WILDCARD_LOOKUP[key]
+
+def _refresh_stack(stack_name, cache_ttl):
+    """Fetch a CloudFormation stack's resources, replacing any copy held in
+       STACK_LOOKUP or the on-disk cache.
+    """
+    stack = {
+        'fetched_at': time.time(),
+        'from_cache': False,
+        'resources': _fetch_stack_resources(stack_name),
+        'paths': None
+    }
+    _write_cached_stack(stack_name, stack, cache_ttl)
+    _store_stack(stack_name, stack)
+    return stack
+
+def _stack_lookup(stack_name, cache_ttl):
+    """Return the lookup for a CloudFormation stack, fetching the stack's
+       resources if neither STACK_LOOKUP nor the on-disk cache hold them.
+    """
     if stack_name not in STACK_LOOKUP:
-        # hunt for it
-        client = boto3.client('cloudformation', region_name=REGION)
-
-        # get all the LogicalResourceId s
-        ids = []
-        paginator = client.get_paginator('list_stack_resources')
-        for res in paginator.paginate(StackName=stack_name):
-            for res2 in res['StackResourceSummaries']:
-                ids.append(res2['LogicalResourceId'])
-
-        stack = {}
-        # now find all the paths
-        for idn in ids:
-            response = client.describe_stack_resource(StackName=stack_name, LogicalResourceId=idn)
-            response = response['StackResourceDetail']
-            physicalId = response['PhysicalResourceId']
-            if 'Metadata' in response:
-                response = json.loads(response['Metadata'])
-                if 'aws:cdk:path' in response:
-                    path = response['aws:cdk:path']
-                    stack[path] = physicalId
-                    #print(path, physicalId)
-
-        # save
-        STACK_LOOKUP[stack_name] = stack
-
-    stack = STACK_LOOKUP[stack_name]
-
-    has_wildcards = '*' in path or '?' in path or '[' in path
-    if has_wildcards:
-        result = []
-        for candidate in stack:
-            if fnmatch.fnmatch(candidate, path):
-                result.append(stack[candidate])
-        if len(result) == 0:
-            raise Exception("pattern {} not found in stack {}".format(path, stack_name))
-        return result
+        stack = _read_cached_stack(stack_name, cache_ttl)
+        if stack is None:
+            return _refresh_stack(stack_name, cache_ttl)
+        stack['from_cache'] = True
+        _store_stack(stack_name, stack)
+
+    return STACK_LOOKUP[stack_name]
+
+def _stack_paths(stack_name, cache_ttl):
+    """Return the physical names of the resources in a CloudFormation stack,
+       keyed on aws:cdk:path.
+    """
+    stack = _stack_lookup(stack_name, cache_ttl)
+    if stack['paths'] is None:
+        stack['paths'] = _fetch_stack_paths(stack_name, stack['resources'])
+        _write_cached_stack(stack_name, stack, cache_ttl)
+
+    return stack['paths']
+
+def _find_attribute(stack_name, path, cache_ttl):
+    """Look up a path in the current copy of a stack, returning None if it
+       does not match any resources.
+    """
+    if WILDCARD_PATTERN.search(path):
+        stack = _stack_paths(stack_name, cache_ttl)
+
+        key = (stack_name, path)
+        if key not in WILDCARD_LOOKUP:
+            # fnmatch.filter compiles the pattern once for the whole scan
+            WILDCARD_LOOKUP[key] = tuple(
+                stack[candidate] for candidate in fnmatch.filter(stack, path))
+
+        return WILDCARD_LOOKUP[key] or None
+
+    resources = _stack_lookup(stack_name, cache_ttl)['resources']
+    logical_name = path[len(stack_name) + 1:]
+    if path.startswith(stack_name + '/') and logical_name in resources:
+        return resources[logical_name]
+
+    return _stack_paths(stack_name, cache_ttl).get(path)
+
+def retrieve_attribute(stack_name, path, cache_ttl=None):
+    """Retrieve an attribute for a CloudFormation resource using boto.
+
+       The path may either be the stack name followed by a logical name, or an
+       aws:cdk:path, which may contain wildcards. The stack's template is only
+       retrieved when an aws:cdk:path is needed.
+
+       Wildcard matches are returned as a tuple, which is shared between
+       lookups of the same pattern.
 
+       Stack lookups are kept in the on-disk cache for cache_ttl seconds; a
+       cache_ttl of None bypasses the cache. A lookup that misses against a
+       cached stack fetches the stack again before giving up, in case it has
+       been updated since it was cached.
+    """
+    #print('retrieve_attribute', stack_name, path)
+
+    result = _find_attribute(stack_name, path, cache_ttl)
+    if result is None and _stack_lookup(stack_name, cache_ttl)['from_cache']:
+        _refresh_stack(stack_name, cache_ttl)
+        result = _find_attribute(stack_name, path, cache_ttl)
+
+    if result is not None:
+        return result
+    elif WILDCARD_PATTERN.search(path):
+        raise Exception("pattern {} not found in stack {}".format(path, stack_name))
     else:
-        if path in stack:
-            return stack[path]
-        else:
-            raise Exception('path {} not found in stack {}'.format(path, stack_name))
+        raise Exception('path {} not found in stack {}'.format(path, stack_name))
 
+@lru_cache(maxsize=1024)
 def parse_cfn_uri(uri):
     """Parse a URI of the form:
 
@@ -72,49 +337,70 @@ def parse_cfn_uri(uri):
        [] denote optional components, whereas <> denotes mandatory components.
 
        If any mandatory components are missing, an exception will be raised.
+
+       Results are cached, as templates often repeat the same URI.
     """
 
-    # Deconstruct URI
-    base_uri, frag = urldefrag(uri)
-    base_uri_parts = urlsplit(base_uri)
-    scheme = base_uri_parts.scheme
+    # Deconstruct URI; urlsplit already separates out any fragment
+    uri_parts = urlsplit(uri)
+    scheme = uri_parts.scheme
 
     # Check URI scheme
     if scheme != "cfn":
         raise Exception("Scheme '" + scheme + "' not supported.")
 
-    return base_uri_parts.netloc, base_uri_parts.netloc + base_uri_parts.path
+    return uri_parts.netloc, uri_parts.netloc + uri_parts.path
 
-def handle_cfn_uri(uri):
+def handle_cfn_uri(uri, cache_ttl=None):
     """Retrieve a stack resource attribute for a CloudFormation resource
        identified by a URI of the form:
 
+       cfn://<stack-name>/<logical-name>
+
+       or:
+
        cfn://cdk_path
     """
 
     # Parse the URI
     stack_name, path = parse_cfn_uri(uri)
 
-    return retrieve_attribute(stack_name, path)
+    return retrieve_attribute(stack_name, path, cache_ttl)
 
 
-def resolve_template_with_cfn_support(template_data, params):
+def resolve_template_with_cfn_support(template_data, params,
+                                      cache_ttl=None):
     """Resolve a JSON-formatted CFN template and resolve any JSON References or
        pre-processor directives using the json_preprocessor library.
 
        An additional URI scheme handler is registered so that templates can
        reference pre-existing resources in existing CloudFormation stacks
-       using a custom 'cfn://' scheme.
+       using a custom 'cfn://' scheme. Stack lookups made for those references
+       are cached on disk for cache_ttl seconds; by default they are not
+       cached at all.
+
+       template_data must be an already-parsed JSON document, not a file
+       object or JSON text; it is never parsed here. File objects are
+       rejected, whereas a string is resolved as a JSON string value.
     """
+    if hasattr(template_data, 'read'):
+        raise Exception("Template must be a parsed JSON document, not a file.")
+
     return resolve(template_data, params, {
-        'cfn': handle_cfn_uri
+        'cfn': lambda uri: handle_cfn_uri(uri, cache_ttl)
     })
 
 
 aws_profile_help_text = 'AWS profile to use when connecting to CloudFormation.'
 
+cache_ttl_help_text = 'Number of seconds for which CloudFormation stack ' \
+                      'lookups are cached between runs.'
+
 minify_help_text = 'Compact the JSON output by removing whitespace.'
 
+no_cache_help_text = 'Always query CloudFormation instead of using ' \
+                     'cached stack lookups.'
+
 output_file_optional_help_text = 'Optional path to which JSON output will ' \
                                  'be written. By default output will be ' \
                                  'written to STDOUT.'
@@ -126,10 +412,19 @@ parameter_help_text = 'A key-value pair to be passed to the template; ' \
 """
 @click.group(no_args_is_help=True,
              invoke_without_command=True)
+@click.option('--cache-ttl',
+              metavar='<seconds>',
+              help=cache_ttl_help_text,
+              type=int,
+              default=CACHE_TTL)
 @click.option('--minify',
               help=minify_help_text,
               is_flag=True,
               default=False)
+@click.option('--no-cache',
+              help=no_cache_help_text,
+              is_flag=True,
+              default=False)
 @click.option('--output-file',
               metavar='<path>',
               help=output_file_optional_help_text,
@@ -144,19 +439,39 @@ parameter_help_text = 'A key-value pair to be passed to the template; ' \
                 metavar='<path-to-document>',
                 type=click.Path(exists=True))
 """
-def run(minify, output_file, parameter, path_to_document):
+def run(minify, output_file, parameter, path_to_document, no_cache=False,
+        cache_ttl=CACHE_TTL):
     """Resolve a CloudFormation template containing JSON pre-processor
        directives.
     """
+    if no_cache:
+        cache_ttl = None
+
     param_dict = dict(param.split('=') for param in parameter)
-    indent = None if minify else 4
-    with open(path_to_document) as data:
-        resolved_tree = resolve_template_with_cfn_support(json.load(data),
-                                                          param_dict)
-        resolved = json.dumps(resolved_tree, indent=indent)
+    with open(path_to_document, 'rb') as data:
+        resolved_tree = resolve_template_with_cfn_support(_load_json(data),
+                                                          param_dict,
+                                                          cache_ttl)
+
+    # Minified output is encoded in one shot, as only that takes the C
+    # encoder; indented output is pure Python either way, so it is streamed
+    # rather than built as a second copy of the document
+    if minify:
+        resolved = _dumps_minified(resolved_tree)
         if output_file is None:
-            print(resolved)
+            # the encoded bytes go straight to the underlying buffer, without
+            # passing through the text layer
+            sys.stdout.flush()
+            sys.stdout.buffer.write(resolved)
+            sys.stdout.buffer.write(b'\n')
         else:
-            with open(output_file, 'w') as f:
+            with open(output_file, 'wb') as f:
                 f.write(resolved)
-                f.close()
+    elif output_file is None:
+        with _buffered_stdout() as out:
+            json.dump(resolved_tree, out, indent=4)
+            out.write('\n')
+    else:
+        # a large buffer means multi-megabyte documents take few writes
+        with open(output_file, 'w', buffering=1 << 20) as f:
+            json.dump(resolved_tree, f, indent=4)
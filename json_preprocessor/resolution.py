@@ -201,8 +201,9 @@ def resolve_node(
         del inner_base_resolver_fn
         return resolve_node(inner_node, doc_args, custom_uri_handlers)
 
-    if isinstance(node, list):
-        # Resolve each element in an array
+    if isinstance(node, (list, tuple)):
+        # Resolve each element in an array, producing a new list; tuples are
+        # treated as arrays so that URI handlers can return shared results
         return [base_resolver_fn(value, base_resolver_fn) for value in node]
 
     elif isinstance(node, dict):
@@ -10,5 +10,5 @@ setup(
     entry_points = {
         'console_scripts': ['json-preprocessor = json_preprocessor.cli:run']
     },
-    requires=['boto', 'click']
+    requires=['boto3', 'click']
 )
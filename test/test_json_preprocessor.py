@@ -1,8 +1,13 @@
+import io
 import json
 import unittest
 import os
+import sys
+import tempfile
+import types
+from unittest import mock
 
-from json_preprocessor import resolve
+from json_preprocessor import cli, resolve
 
 
 test_cases = [
@@ -24,5 +29,272 @@ class TestResolution(unittest.TestCase):
                 with open(test_case[1]) as expected:
                     self.assertEqual(json.load(expected), actual)
 
+    def test_tuple_from_uri_handler(self):
+        node = {'$join': [[{'$ref': 'tuple://'}, ['c']], ['*']]}
+        actual = resolve(node, dict(), {'tuple': lambda uri: ('a', 'b')})
+        self.assertEqual(['a', 'b', '*', 'c'], actual)
+
+
+class StubCloudFormationClient:
+    """Records the requests made against a single stack."""
+
+    def __init__(self, pages, template):
+        self.pages = pages
+        self.template = template
+        self.calls = []
+
+    def list_stack_resources(self, **kwargs):
+        self.calls.append(('list_stack_resources', kwargs.get('NextToken')))
+        index = int(kwargs.get('NextToken', 0))
+        response = {'StackResourceSummaries': self.pages[index]}
+        if index + 1 < len(self.pages):
+            response['NextToken'] = str(index + 1)
+        return response
+
+    def get_template(self, **kwargs):
+        self.calls.append(('get_template', kwargs['TemplateStage']))
+        return {'TemplateBody': self.template}
+
+
+def summary(logical_id, physical_id):
+    return {'LogicalResourceId': logical_id, 'PhysicalResourceId': physical_id}
+
+
+def cdk_resource(path):
+    return {'Type': 'AWS::CDK::Stub', 'Metadata': {'aws:cdk:path': path}}
+
+
+class TestCfnLookup(unittest.TestCase):
+    template = {
+        'Resources': {
+            'Bucket83908E77': cdk_resource('S/Bucket/Resource'),
+            'Queue4A7E3555': cdk_resource('S/Queue/Resource'),
+            'Topic883A37A3': cdk_resource('S/Topic/Resource')
+        }
+    }
+
+    pages = [
+        [summary('Bucket83908E77', 'bucket-1'),
+         summary('Queue4A7E3555', 'queue-1')],
+        [summary('Topic883A37A3', 'topic-1')]
+    ]
+
+    def setUp(self):
+        self.client = StubCloudFormationClient(self.pages, self.template)
+        boto3 = types.ModuleType('boto3')
+        boto3.client = lambda *args, **kwargs: self.client
+        botocore = types.ModuleType('botocore')
+        botocore_config = types.ModuleType('botocore.config')
+        botocore_config.Config = lambda **kwargs: None
+
+        self.cache_dir = tempfile.TemporaryDirectory()
+        patches = [
+            mock.patch.dict(sys.modules, {
+                'boto3': boto3,
+                'botocore': botocore,
+                'botocore.config': botocore_config
+            }),
+            mock.patch.dict(os.environ, {'AWS_REGION': 'ap-southeast-2'}),
+            mock.patch.object(cli, 'CACHE_DIR', self.cache_dir.name)
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(self.cache_dir.cleanup)
+
+        self.reset()
+        self.addCleanup(self.reset)
+
+    def reset(self):
+        cli.STACK_LOOKUP.clear()
+        cli.WILDCARD_LOOKUP.clear()
+        cli._region.cache_clear()
+        cli._cfn_client.cache_clear()
+
+    def test_next_token_paging(self):
+        self.assertEqual('topic-1', cli.handle_cfn_uri('cfn://S/Topic883A37A3'))
+        self.assertEqual([('list_stack_resources', None),
+                          ('list_stack_resources', '1')], self.client.calls)
+
+    def test_logical_name_lookup_only_lists_resources(self):
+        self.assertEqual('bucket-1',
+                         cli.handle_cfn_uri('cfn://S/Bucket83908E77'))
+        self.assertNotIn(('get_template', 'Processed'), self.client.calls)
+
+    def test_unknown_logical_name_falls_through_to_template(self):
+        with self.assertRaisesRegex(Exception, 'path S/Nope not found'):
+            cli.handle_cfn_uri('cfn://S/Nope')
+        self.assertEqual([('list_stack_resources', None),
+                          ('list_stack_resources', '1'),
+                          ('get_template', 'Processed')], self.client.calls)
+
+    def test_cdk_path_lookup(self):
+        self.assertEqual('queue-1',
+                         cli.handle_cfn_uri('cfn://S/Queue/Resource'))
+        self.assertEqual(('bucket-1', 'queue-1', 'topic-1'),
+                         cli.handle_cfn_uri('cfn://S/*/Resource'))
+        self.assertEqual(1, self.client.calls.count(
+            ('get_template', 'Processed')))
+
+    def test_rebuilt_stack_discards_wildcard_matches(self):
+        self.assertEqual(('bucket-1', 'queue-1', 'topic-1'),
+                         cli.handle_cfn_uri('cfn://S/*/Resource',
+                                            cli.CACHE_TTL))
+
+        # another run has since cached a newer copy of the stack
+        stack = dict(cli.STACK_LOOKUP['S'], paths={'S/Bucket/Resource': 'b-2'})
+        cli._write_cached_stack('S', stack, cli.CACHE_TTL)
+
+        cli.STACK_LOOKUP.clear()
+        self.assertEqual(('b-2',), cli.handle_cfn_uri('cfn://S/*/Resource',
+                                                      cli.CACHE_TTL))
+
+    def test_yaml_template_has_no_cdk_paths(self):
+        self.client.template = 'Resources:\n  Bucket83908E77: {}\n'
+        with self.assertRaisesRegex(Exception, 'path S/Nope not found'):
+            cli.handle_cfn_uri('cfn://S/Nope', cli.CACHE_TTL)
+
+    def test_cache_hit_within_ttl(self):
+        with mock.patch.object(cli.time, 'time', return_value=1000):
+            cli.handle_cfn_uri('cfn://S/Bucket/Resource', cli.CACHE_TTL)
+        calls = list(self.client.calls)
+
+        cli.STACK_LOOKUP.clear()
+        with mock.patch.object(cli.time, 'time', return_value=1059):
+            self.assertEqual('bucket-1',
+                             cli.handle_cfn_uri('cfn://S/Bucket/Resource',
+                                                cli.CACHE_TTL))
+        self.assertEqual(calls, self.client.calls)
+
+    def test_cache_expiry(self):
+        with mock.patch.object(cli.time, 'time', return_value=1000):
+            cli.handle_cfn_uri('cfn://S/Bucket83908E77', cli.CACHE_TTL)
+
+        cli.STACK_LOOKUP.clear()
+        with mock.patch.object(cli.time, 'time', return_value=1060):
+            cli.handle_cfn_uri('cfn://S/Bucket83908E77', cli.CACHE_TTL)
+        self.assertEqual(2, self.client.calls.count(
+            ('list_stack_resources', None)))
+
+    def test_cached_stack_is_refetched_when_lookup_misses(self):
+        self.client.pages = self.pages[:1]
+        with mock.patch.object(cli.time, 'time', return_value=1000):
+            cli.handle_cfn_uri('cfn://S/Bucket83908E77', cli.CACHE_TTL)
+
+        # the stack is deployed again with a new resource
+        self.client.pages = self.pages
+        self.client.calls.clear()
+        cli.STACK_LOOKUP.clear()
+        with mock.patch.object(cli.time, 'time', return_value=1020):
+            self.assertEqual('topic-1', cli.handle_cfn_uri(
+                'cfn://S/Topic883A37A3', cli.CACHE_TTL))
+            self.assertEqual('topic-1', cli.handle_cfn_uri(
+                'cfn://S/Topic/Resource', cli.CACHE_TTL))
+
+            # the refetched stack replaced the cached copy
+            cli.STACK_LOOKUP.clear()
+            self.assertEqual(('bucket-1', 'queue-1', 'topic-1'),
+                             cli.handle_cfn_uri('cfn://S/*/Resource',
+                                                cli.CACHE_TTL))
+        self.assertEqual([('get_template', 'Processed'),
+                          ('list_stack_resources', None),
+                          ('list_stack_resources', '1'),
+                          ('get_template', 'Processed')], self.client.calls)
+
+    def test_lookups_are_not_cached_by_default(self):
+        cli.handle_cfn_uri('cfn://S/Bucket83908E77')
+        self.assertEqual([], os.listdir(self.cache_dir.name))
+
+    def test_unusable_cache_falls_back(self):
+        blocker = os.path.join(self.cache_dir.name, 'not-a-directory')
+        open(blocker, 'w').close()
+        with mock.patch.object(cli, 'CACHE_DIR', blocker):
+            self.assertEqual('bucket-1',
+                             cli.handle_cfn_uri('cfn://S/Bucket83908E77',
+                                                cli.CACHE_TTL))
+
+    def test_no_cache(self):
+        document = os.path.join(self.cache_dir.name, 'document.json')
+        output = os.path.join(self.cache_dir.name, 'output.json')
+        with open(document, 'w') as f:
+            json.dump({'bucket': {'$ref': 'cfn://S/Bucket83908E77'}}, f)
+
+        for _ in range(2):
+            cli.STACK_LOOKUP.clear()
+            cli.run(True, output, [], document, no_cache=True)
+        with open(output) as f:
+            self.assertEqual({'bucket': 'bucket-1'}, json.load(f))
+
+        self.assertEqual(2, self.client.calls.count(
+            ('list_stack_resources', None)))
+        self.assertEqual(['document.json', 'output.json'],
+                         sorted(os.listdir(self.cache_dir.name)))
+
+class TestCli(unittest.TestCase):
+    def test_load_keeps_wide_integers(self):
+        raw = b'{"big": 123456789012345678901234567890}'
+        self.assertEqual({'big': 123456789012345678901234567890},
+                         cli._load_json(io.BytesIO(raw)))
+
+    def test_load_accepts_byte_order_mark(self):
+        raw = b'\xef\xbb\xbf{"name": "caf\xc3\xa9"}'
+        self.assertEqual({'name': 'caf\u00e9'},
+                         cli._load_json(io.BytesIO(raw)))
+
+    def test_minified_output_matches_across_destinations(self):
+        with tempfile.TemporaryDirectory() as wd:
+            document = os.path.join(wd, 'document.json')
+            output = os.path.join(wd, 'output.json')
+            with open(document, 'w') as f:
+                f.write('{"name": "caf\\u00e9", "size": 1e100}')
+
+            cli.run(True, output, [], document)
+            with open(output, 'rb') as f:
+                written = f.read()
+
+            stdout = io.TextIOWrapper(io.BytesIO())
+            with mock.patch.object(sys, 'stdout', stdout):
+                cli.run(True, None, [], document)
+            printed = stdout.buffer.getvalue()
+
+        self.assertEqual(written + b'\n', printed)
+        self.assertEqual({'name': 'caf\u00e9', 'size': 1e100},
+                         json.loads(written))
+
+    def test_indented_output_matches_across_destinations(self):
+        tree = {'name': 'caf\u00e9', 'items': [1, 2.5, None]}
+        with tempfile.TemporaryDirectory() as wd:
+            document = os.path.join(wd, 'document.json')
+            output = os.path.join(wd, 'output.json')
+            with open(document, 'w') as f:
+                json.dump(tree, f)
+
+            cli.run(False, output, [], document)
+            with open(output, 'rb') as f:
+                written = f.read()
+
+            stdout = io.TextIOWrapper(io.BytesIO(), encoding='utf-8')
+            with mock.patch.object(sys, 'stdout', stdout):
+                cli.run(False, None, [], document)
+            printed = stdout.buffer.getvalue()
+
+        self.assertEqual(json.dumps(tree, indent=4).encode('utf-8'), written)
+        self.assertEqual(written + b'\n', printed)
+        self.assertFalse(stdout.closed)
+
+    def test_minified_output_escapes_lone_surrogates(self):
+        self.assertEqual(b'{"a":"\\ud800"}',
+                         cli._dumps_minified({'a': '\ud800'}))
+
+    def test_minified_output_keeps_non_finite_floats(self):
+        self.assertEqual(b'{"a":NaN,"b":Infinity,"c":null}',
+                         cli._dumps_minified({'a': float('nan'),
+                                              'b': float('inf'),
+                                              'c': None}))
+
+    def test_minified_output_keeps_wide_integers(self):
+        self.assertEqual(b'{"big":1267650600228229401496703205376}',
+                         cli._dumps_minified({'big': 2 ** 100}))
+
 if __name__ == '__main__':
    unittest.main()